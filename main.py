@@ -1,11 +1,19 @@
 import os
+import re
+import html
 import json
+import time
+import random
 import datetime
-import pytz
 import gspread
 import requests
-import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from operator import itemgetter
+from zoneinfo import ZoneInfo
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
@@ -19,8 +27,50 @@ SCOPES = [
 ]
 
 CONFIG_FILE = "config.json"
+_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY") or "<YOUR_API_KEY_HERE>"
+SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS") or "service_account.json"
 SHEET_NAME = "CommuteData"  # Master spreadsheet name
-TIMEZONE = pytz.timezone("America/Chicago")
+TIMEZONE = ZoneInfo("America/Chicago")
+SHEET_HEADERS = ["Timestamp", "Day", "Route", "Duration (min)", "Length (miles)", "Directions"]
+LAST_RUN_HEADERS = ["Route", "LastRun"]
+MAX_FETCH_WORKERS = 8  # matches the HTTP connection pool size
+SHEETS_MAX_RETRIES = 5  # attempts per Sheets write when rate limited (429)
+MAPS_MAX_RETRY_WAIT = 5  # seconds; caps both backoff and Retry-After between Maps retries
+
+class _CappedRetry(Retry):
+    """Retry that honors a 429's Retry-After header, but never waits longer than MAPS_MAX_RETRY_WAIT."""
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, MAPS_MAX_RETRY_WAIT)
+
+# Shared HTTP session so warm invocations reuse the TLS connection to Google Maps
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    # Bounded so a stalled call can't outlast the function timeout: at most 3 attempts
+    # (one connect and one read retry) of 10 s each, plus 2 waits of <= MAPS_MAX_RETRY_WAIT
+    max_retries=_CappedRetry(
+        total=2,
+        connect=1,
+        read=1,
+        backoff_factor=0.5,
+        backoff_max=MAPS_MAX_RETRY_WAIT,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,  # hand the final error response back to get_routes
+    ),
+))
+_SESSION.headers["Connection"] = "keep-alive"
+
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_WBR_TAG_RE = re.compile(r"<wbr\s*/?>", re.IGNORECASE)
+_GET_INSTRUCTIONS = itemgetter("html_instructions")
+
+# Parsed config.json, reused across warm invocations until the file changes
+_CONFIG_CACHE = {"mtime": None, "data": None}
 
 def now_chicago():
     return datetime.now(TIMEZONE).replace(second=0, microsecond=0)
@@ -30,6 +80,12 @@ def now_chicago():
 # ============================================
 
 def get_gspread_client():
+    # Scheduled runs authenticate as a service account: no browser flow, no token.json writes
+    if os.path.exists(SERVICE_ACCOUNT_FILE):
+        creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        return gspread.authorize(creds)
+
+    # Local fallback: interactive OAuth with a cached user token
     creds = None
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
@@ -40,51 +96,87 @@ def get_gspread_client():
             token.write(creds.to_json())
     return gspread.authorize(creds)
 
-def get_or_create_worksheet(sh, name):
-    """Return worksheet if exists, else create it and ensure headers exist."""
-    try:
-        ws = sh.worksheet(name)
-    except gspread.exceptions.WorksheetNotFound:
+def _retry(fn, *args, **kwargs):
+    """Call a gspread write, backing off with jitter while Sheets answers 429."""
+    for attempt in range(SHEETS_MAX_RETRIES):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code != 429 or attempt == SHEETS_MAX_RETRIES - 1:
+                raise
+            delay = (2 ** attempt) + random.uniform(0, 1)
+            print(f"⏳ Sheets rate limited, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def fetch_header_rows(sh, names, existing):
+    """Fetch row 1 of every existing tab in `names` with one values.batchGet call."""
+    names = [name for name in dict.fromkeys(names) if name in existing]
+    if not names:
+        return {}
+
+    ranges = ["'{}'!A1:F1".format(name.replace("'", "''")) for name in names]
+    value_ranges = sh.values_batch_get(ranges).get("valueRanges", [])
+    return {
+        name: vr.get("values", [[]])[0]
+        for name, vr in zip(names, value_ranges)
+    }
+
+def get_or_create_worksheet(sh, name, existing, header_row=None):
+    """
+    Return worksheet if exists, else create it and ensure headers exist.
+    `existing` is {title: worksheet} from one sh.worksheets() call and is updated on create.
+    `header_row` is the tab's cached first row (see fetch_header_rows); it is read if not given.
+    """
+    ws = existing.get(name)
+    if ws is None:
         ws = sh.add_worksheet(title=name, rows=1000, cols=10)
+        existing[name] = ws
         print(f"🆕 Created new sheet '{name}'")
+        header_row = []
+
+    ensure_worksheet_headers(ws, name, header_row)
+    return ws
 
-    # --- ensure headers ---
-    headers = ["Timestamp", "Day", "Route", "Duration (min)", "Length (miles)", "Directions"]
-    existing_values = ws.get_all_values()
+def ensure_worksheet_headers(ws, name, header_row=None):
+    """Write the standard headers (LAST_RUN_HEADERS for LastRunLog) into row 1 if it is empty."""
+    if header_row is None:
+        header_row = ws.row_values(1)
 
-    # Treat [[""]] (Google’s default empty row) as empty
-    if not existing_values or all(not any(cell.strip() for cell in row) for row in existing_values):
-        ws.clear()
-        ws.append_row(headers)
+    # Treat [""] (Google’s default empty row) as empty
+    if not any(str(cell).strip() for cell in header_row):
+        headers = LAST_RUN_HEADERS if name == "LastRunLog" else SHEET_HEADERS
+        ws.update(range_name="A1", values=[headers])
         print(f"🪶 Added headers to sheet '{name}'")
-    elif existing_values[0] != headers and name != "LastRunLog":
+    elif header_row != SHEET_HEADERS and name != "LastRunLog":
         print(f"⚠️ Header mismatch in '{name}' — consider standardizing manually")
 
-    return ws
-
 
 # ============================================
 # GOOGLE MAPS DIRECTIONS
 # ============================================
 def get_routes(origin, destination):
-    api_key = os.getenv("GOOGLE_MAPS_API_KEY") or "<YOUR_API_KEY_HERE>"
-    url = (
-        "https://maps.googleapis.com/maps/api/directions/json"
-        f"?origin={origin}"
-        f"&destination={destination}"
-        f"&mode=driving"
-        f"&alternatives=true"
-        f"&departure_time=now"
-        f"&traffic_model=best_guess"
-        f"&key={api_key}"
-    )
-
-    response = requests.get(url)
-    if response.status_code != 200:
-        print(f"⚠️ Google Maps API error: {response.text}")
+    url = "https://maps.googleapis.com/maps/api/directions/json"
+    params = {
+        "origin": origin,
+        "destination": destination,
+        "mode": "driving",
+        "alternatives": "true",
+        "departure_time": "now",
+        "traffic_model": "best_guess",
+        "key": _API_KEY,
+    }
+
+    # Failures only skip this route; the other routes fetched in parallel are still logged
+    try:
+        response = _SESSION.get(url, params=params, timeout=10)
+        if response.status_code != 200:
+            print(f"⚠️ Google Maps API error: {response.text}")
+            return []
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"⚠️ Google Maps request failed for {origin} → {destination}: {e}")
         return []
 
-    data = response.json()
     routes = data.get("routes", [])
 
     # Print the key data we care about for sanity
@@ -97,38 +189,65 @@ def get_routes(origin, destination):
     return routes
 
 
+def fetch_directions(pairs):
+    """
+    Return {(origin, destination): routes} for the given pairs.
+    Each distinct pair is fetched once per run, in parallel; nothing is cached
+    across runs so every logged row reflects live traffic.
+    """
+    unique_pairs = list(dict.fromkeys(pairs))
+    with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as pool:
+        fetched = pool.map(lambda pair: get_routes(*pair), unique_pairs)
+        return dict(zip(unique_pairs, fetched))
+
+
 # ============================================
 # LOGGING ROUTES
 # ============================================
-def log_route_to_sheet(ws, ws_log, route_name, origin, destination, interval, days=None, start=None, end=None):
-    now = now_chicago()
-
-    # --- check if today/time are within window ---
+def is_in_active_window(route_name, now, days=None, start=None, end=None):
+    """
+    Return True if `now` falls on one of the route's days and inside its start/end window.
+    `days` is a set of weekday names and `start`/`end` are datetime.time (see parse_route_schedules).
+    """
     if days and now.strftime("%A") not in days:
         print(f"🗓 Skipping {route_name} (today not in active days)")
-        return
+        return False
     if start and end:
-        t = now.time()
-        start_t = datetime.strptime(start, "%H:%M").time()
-        end_t = datetime.strptime(end, "%H:%M").time()
-        if not (start_t <= t <= end_t):
-            print(f"⏰ Skipping {route_name} (outside {start}-{end})")
-            return
+        if not (start <= now.time() <= end):
+            print(f"⏰ Skipping {route_name} (outside {start:%H:%M}-{end:%H:%M})")
+            return False
+    return True
 
-    # --- check last run from log ---
-    last_dt = get_last_run_time(ws_log, route_name)
+
+def is_route_due(last_run, route_name, now, interval):
+    """Return True if at least `interval` minutes have passed since the route was last logged."""
+    last_dt = last_run.get(route_name)
     if last_dt:
         diff = (now - last_dt).total_seconds() / 60.0
         if diff < float(interval):
             print(f"⏸ Skipping {route_name} (last logged {diff:.1f} min ago)")
-            return
+            return False
+    return True
+
+
+def clean_instruction(html_text):
+    """Strip all tags (<b>, <div ...>, <wbr/>) and entities (&nbsp;) from a Directions step."""
+    # <wbr/> is an in-word break hint ("W/<wbr/>I-94"), so drop it outright; other tags
+    # become spaces so "left<div>Destination" doesn't run together, and split() collapses them
+    text = _WBR_TAG_RE.sub("", html_text)
+    return " ".join(html.unescape(_HTML_TAG_RE.sub(" ", text)).split())
 
-    # --- fetch route data (only if within window and interval) ---
-    routes = get_routes(origin, destination)
+
+def log_route_to_sheet(ws, pending_updates, route_name, routes, now):
     if not routes:
         print(f"⚠️ No routes found for {route_name}")
         return
 
+    # --- format the timestamp once; every alternative shares it ---
+    ts_str = now.strftime("%Y-%m-%d %H:%M:%S")
+    day_str = now.strftime("%A")
+
+    rows_to_append = []
     for r in routes:
         leg = r["legs"][0]
 
@@ -139,102 +258,186 @@ def log_route_to_sheet(ws, ws_log, route_name, origin, destination, interval, da
 
         # --- turn-by-turn steps ---
         steps = leg.get("steps", [])
-        turn_by_turn = " → ".join(
-            step["html_instructions"].replace("<b>", "").replace("</b>", "")
-            for step in steps
-        )
+        turn_by_turn = " → ".join(map(clean_instruction, map(_GET_INSTRUCTIONS, steps)))
 
-        # --- clean Google Maps link (no polyline junk) ---
-        encoded_origin = urllib.parse.quote(origin)
-        encoded_destination = urllib.parse.quote(destination)
-        maps_link = (
-            f"https://www.google.com/maps/dir/?api=1"
-            f"&origin={encoded_origin}"
-            f"&destination={encoded_destination}"
-            f"&travelmode=driving"
-            f"&dir_action=navigate"
-        )
-
-        # --- append to sheet ---
-        ws.append_row([
-            now.strftime("%Y-%m-%d %H:%M:%S"),
-            now.strftime("%A"),
+        rows_to_append.append([
+            ts_str,
+            day_str,
             summary,
             duration_min,
             distance_mi,
             turn_by_turn,
         ])
 
-    # --- update last run ONLY after successful log ---
-    update_last_run_time(ws_log, route_name, now)
+    # --- append all alternatives in one request; RAW stores values as-is (no formula parsing) ---
+    _retry(ws.append_rows, rows_to_append, value_input_option="RAW")
+
+    # --- queue last run update ONLY after successful log ---
+    pending_updates[route_name] = now.isoformat()
 
 
-def get_last_run_time(ws_log, route_name):
-    """Get last run timestamp for a given route from the LastRunLog sheet."""
+def load_last_run_log(ws_log):
+    """
+    Read the LastRunLog sheet once.
+    Returns ({route name: last run datetime}, {route name: sheet row}),
+    or route_to_row=None if the read failed.
+    """
+    last_run = {}
+    route_to_row = {}
     try:
-        records = ws_log.get_all_records()
-        for row in records:
-            if row.get("Route") == route_name:
-                val = row.get("LastRun")
-                if val:
-                    try:
-                        last_dt = datetime.fromisoformat(val)
-                        if last_dt.tzinfo is None:
-                            last_dt = TIMEZONE.localize(last_dt)
-                        return last_dt  # ✅ return inside the loop once found
-                    except ValueError:
-                        print(f"⚠️ Invalid date format for {route_name}: {val}")
-                        return None
-        # If no matching route found
-        return None
+        values = ws_log.get_all_values()
     except Exception as e:
-        print(f"⚠️ Could not read LastRunLog for {route_name}: {e}")
-        return None
+        print(f"⚠️ Could not read LastRunLog: {e}")
+        return last_run, None
+
+    # Keyed on columns A/B (route, timestamp) rather than header names, since
+    # older LastRunLog tabs were created with the route-tab headers
+    for row_num, row in enumerate(values[1:], start=2):
+        route_name = row[0].strip() if row else ""
+        if route_name and route_name not in route_to_row:
+            route_to_row[route_name] = row_num
+
+        val = row[1].strip() if len(row) > 1 else ""
+        if not route_name or not val or route_name in last_run:
+            continue
+        try:
+            last_dt = datetime.fromisoformat(val)
+        except ValueError:
+            print(f"⚠️ Invalid date format for {route_name}: {val}")
+            last_run[route_name] = None
+            continue
+        if last_dt.tzinfo is None:
+            last_dt = last_dt.replace(tzinfo=TIMEZONE)
+        last_run[route_name] = last_dt
+    return last_run, route_to_row
+
+
+def save_last_run_times(ws_log, route_to_row, pending_updates):
+    """
+    Write all queued LastRun timestamps with one batch update plus one append.
+    Existing rows are located via `route_to_row` (from load_last_run_log), never ws_log.find.
+    """
+    if not pending_updates:
+        return
+    if route_to_row is None:
+        print("⚠️ Skipping LastRunLog update (log could not be read)")
+        return
 
+    updates = []
+    new_rows = []
+    for route_name, timestamp in pending_updates.items():
+        row = route_to_row.get(route_name)
+        if row:
+            updates.append({"range": f"B{row}", "values": [[timestamp]]})
+        else:
+            new_rows.append([route_name, timestamp])
 
-def update_last_run_time(ws_log, route_name, timestamp):
-    """Update or insert the LastRun timestamp for the given route."""
     try:
-        cell = ws_log.find(route_name)
-        if cell:
-            # Update existing row
-            ws_log.update_cell(cell.row, 2, timestamp.isoformat())
-        else:
-            # Append a new route entry
-            ws_log.append_row([route_name, timestamp.isoformat()])
-            print(f"🆕 Added new route entry to LastRunLog: {route_name}")
+        if updates:
+            _retry(ws_log.batch_update, updates)
+        if new_rows:
+            _retry(ws_log.append_rows, new_rows)
+            for route_name, _ in new_rows:
+                print(f"🆕 Added new route entry to LastRunLog: {route_name}")
     except Exception as e:
-        print(f"⚠️ Failed to update LastRunLog for {route_name}: {e}")
+        print(f"⚠️ Failed to update LastRunLog: {e}")
 
 
 # ============================================
 # MAIN LOGIC
 # ============================================
+def parse_route_schedules(config):
+    """Convert each route's start/end to datetime.time and days to a frozenset, once per load."""
+    for route in config["routes"]:
+        for key in ("start", "end"):
+            if isinstance(route.get(key), str):
+                route[key] = datetime.strptime(route[key], "%H:%M").time()
+        if route.get("days"):
+            route["days"] = frozenset(route["days"])
+    return config
+
+
+def load_config():
+    """Return the parsed config, re-reading config.json only when its mtime changes."""
+    mtime = os.stat(CONFIG_FILE).st_mtime
+    if mtime == _CONFIG_CACHE["mtime"]:
+        return _CONFIG_CACHE["data"]
+
+    with open(CONFIG_FILE) as f:
+        config = parse_route_schedules(json.load(f))
+    _CONFIG_CACHE["mtime"] = mtime
+    _CONFIG_CACHE["data"] = config
+    return config
+
+
+def route_tab_name(route):
+    # Each route gets its own tab, named after route["name"]
+    return route["name"].replace("/", "-")  # avoid invalid characters
+
+
 def run_commute_tracker():
     print("🚗 Starting commute tracker...")
 
+    config = load_config()
+
+    # --- filter by day/time window before touching Sheets; most cron ticks stop here ---
+    now = now_chicago()
+    active_routes = [
+        route for route in config["routes"]
+        if is_in_active_window(
+            route_name=route["name"],
+            now=now,
+            days=route.get("days"),
+            start=route["start"],
+            end=route["end"]
+        )
+    ]
+    if not active_routes:
+        print("💤 No routes in their active window — nothing to do")
+        return
+
     gc = get_gspread_client()
     sh = gc.open("CommuteData")  # one master spreadsheet
-    ws_log = get_or_create_worksheet(sh, "LastRunLog")
 
-    with open(CONFIG_FILE) as f:
-        config = json.load(f)
+    # --- probe existing tabs and all header rows up front (2 API calls total) ---
+    existing = {ws.title: ws for ws in sh.worksheets()}
+    tab_names = ["LastRunLog"] + [route_tab_name(route) for route in active_routes]
+    header_rows = fetch_header_rows(sh, tab_names, existing)
 
-    for route in config["routes"]:
-        # Each route gets its own tab, named after route["name"]
-        tab_name = route["name"].replace("/", "-")  # avoid invalid characters
-        ws = get_or_create_worksheet(sh, tab_name)
+    ws_log = get_or_create_worksheet(sh, "LastRunLog", existing, header_rows.get("LastRunLog", []))
+    last_run, route_to_row = load_last_run_log(ws_log)
 
-        log_route_to_sheet(
-            ws=ws,
-            ws_log=ws_log,
+    # --- decide which routes need work before issuing any Maps calls ---
+    due_routes = [
+        route for route in active_routes
+        if is_route_due(
+            last_run=last_run,
             route_name=route["name"],
-            origin=route["origin"],
-            destination=route["destination"],
-            interval=route.get("interval", 15),
-            start=route["start"],
-            end=route["end"]
+            now=now,
+            interval=route.get("interval", 15)
         )
+    ]
+
+    # --- fetch directions once per distinct origin/destination, in parallel ---
+    directions = fetch_directions([(route["origin"], route["destination"]) for route in due_routes])
+
+    pending_updates = {}
+    try:
+        for route in due_routes:
+            routes = directions[(route["origin"], route["destination"])]
+            tab_name = route_tab_name(route)
+            ws = get_or_create_worksheet(sh, tab_name, existing, header_rows.get(tab_name, []))
+
+            log_route_to_sheet(
+                ws=ws,
+                pending_updates=pending_updates,
+                route_name=route["name"],
+                routes=routes,
+                now=now
+            )
+    finally:
+        # Save LastRun for routes already logged even if a later route failed
+        save_last_run_times(ws_log, route_to_row, pending_updates)
 
 
 # ============================================